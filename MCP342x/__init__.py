@@ -1,14 +1,80 @@
 """Access Microchip MCP342x analogue to digital converters."""
 
 import logging
+import sys
+import threading
 import time
+import weakref
 
+try:
+    from smbus2 import i2c_msg
+except ImportError:
+    i2c_msg = None
 
 __author__ = 'Steve Marple'
 __version__ = '0.3.5'
 __license__ = 'MIT'
 
 
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    # Python 2
+    _monotonic = time.time
+
+try:
+    TimeoutError
+except NameError:
+    # Python 2
+    TimeoutError = IOError
+
+if sys.version_info[0] >= 3:
+    _msg_data = bytes
+else:
+    # bytes() is str() on Python 2
+    _msg_data = list
+
+
+class _BarrierAborted(RuntimeError):
+    pass
+
+
+class _Barrier(object):
+    """Reusable barrier for a fixed number of threads.
+
+    threading.Barrier requires Python 3.2 or later. If abort() is
+    called all current and future calls to wait() raise
+    _BarrierAborted."""
+
+    def __init__(self, parties):
+        self._parties = parties
+        self._count = 0
+        self._generation = 0
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def wait(self):
+        with self._cond:
+            if self._aborted:
+                raise _BarrierAborted()
+            generation = self._generation
+            self._count += 1
+            if self._count == self._parties:
+                self._count = 0
+                self._generation += 1
+                self._cond.notify_all()
+                return
+            while generation == self._generation and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise _BarrierAborted()
+
+    def abort(self):
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+
 class MCP342x(object):
     """
     Class to represent MCP342x ADC.
@@ -19,6 +85,12 @@ class MCP342x(object):
     _channel_mask         = 0b01100000
     _not_ready_mask       = 0b10000000
 
+    # Masks to clear each field of the configuration
+    _gain_clear_mask            = ~_gain_mask & 0x7f
+    _resolution_clear_mask      = ~_resolution_mask & 0x7f
+    _continuous_mode_clear_mask = ~_continuous_mode_mask & 0x7f
+    _channel_clear_mask         = ~_channel_mask & 0x7f
+
     _gain_to_config = {1: 0b00,
                        2: 0b01,
                        4: 0b10,
@@ -32,6 +104,12 @@ class MCP342x(object):
                           2: 0b1000000, 
                           3: 0b1100000}
 
+    # Inverse lookups, built from the tables above so that they cannot
+    # disagree
+    _config_to_gain = {v: k for k, v in _gain_to_config.items()}
+    _config_to_resolution = {v: k for k, v in _resolution_to_config.items()}
+    _config_to_channel = {v: k for k, v in _channel_to_config.items()}
+
     _conversion_time = {12: 1.0/240,
                         14: 1.0/60,
                         16: 1.0/15,
@@ -42,9 +120,48 @@ class MCP342x(object):
                           16: 62.5e-6,
                           18: 15.625e-6}
 
+    # Bytes to read, including the configuration byte, and the masks
+    # needed to sign extend the count.
+    _resolution_to_bytes = {12: 3,
+                            14: 3,
+                            16: 3,
+                            18: 4}
+    _resolution_to_count_mask = {12: (1 << 12) - 1,
+                                 14: (1 << 14) - 1,
+                                 16: (1 << 16) - 1,
+                                 18: (1 << 18) - 1}
+    _resolution_to_sign_bit = {12: 1 << 11,
+                               14: 1 << 13,
+                               16: 1 << 15,
+                               18: 1 << 17}
+
+    # Fraction of the nominal conversion time to sleep before the
+    # first poll of the not ready bit, and the weight given to each
+    # new observation when adapting it.
+    _default_sleep_factor = 0.9
+    _sleep_factor_weight = 0.25
+
+    # Conversions no longer than this (12 and 14 bit) are not worth
+    # sleeping for, the not ready bit is polled straight away.
+    _max_poll_only_time = 1.0/60
+
+    # Interval between polls of the not ready bit, and how long to
+    # keep polling (in conversion times) before giving up. The
+    # datasheet allows conversions to take up to 1.36 times the
+    # nominal time, leave a good margin for scheduling delays too.
+    _poll_interval = 0.001
+    _timeout_factor = 4
+
+    # Maximum number of messages accepted by the Linux I2C_RDWR ioctl
+    _max_rdwr_msgs = 42
+
     @staticmethod
     def general_call_reset(bus):
         bus.write_byte(0, 6)
+        try:
+            MCP342x._device_configs.pop(bus, None)
+        except TypeError:
+            pass
         return
 
     @staticmethod
@@ -60,115 +177,292 @@ class MCP342x(object):
 
     @staticmethod
     def config_to_gain(config):
-        return [g for g, c in iter(MCP342x._gain_to_config.items()) if c == config & MCP342x._gain_mask][0]
+        return MCP342x._config_to_gain[config & MCP342x._gain_mask]
 
     @staticmethod
     def config_to_resolution(config):
-        return [g for g, c in iter(MCP342x._resolution_to_config.items()) if c == config & MCP342x._resolution_mask][0]
+        return MCP342x._config_to_resolution[
+            config & MCP342x._resolution_mask]
 
     @staticmethod
     def config_to_lsb(config):
-        return MCP342x._resolution_to_lsb[MCP342x.config_to_resolution(config)]
+        return MCP342x._resolution_to_lsb[MCP342x._config_to_resolution[
+            config & MCP342x._resolution_mask]]
 
     @staticmethod
     def config_to_str(config, width=8):
-        n = config & 0x7f
-        s = bin(n)[2:]
-        return '0b' + ('0' * (width-len(s))) + s
+        return '0b{0:0{1}b}'.format(config & 0x7f, width)
+
+    # Configuration last written to each device, keyed by bus and then
+    # by address. Buses which cannot be weakly referenced are not
+    # tracked.
+    _device_configs = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _get_device_config(bus, address):
+        try:
+            return MCP342x._device_configs[bus].get(address)
+        except (KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def _set_device_config(bus, address, config):
+        try:
+            configs = MCP342x._device_configs.setdefault(bus, {})
+        except TypeError:
+            return
+        configs[address] = config & 0x7f
+
+    @staticmethod
+    def _forget_device_config(bus, address):
+        # The device may not hold the configuration recorded for it,
+        # so it must be written again next time.
+        try:
+            MCP342x._device_configs[bus].pop(address, None)
+        except (KeyError, TypeError):
+            pass
 
     @staticmethod
     def configure_device(bus, address, config):
-        logger.debug('Configure device ' + hex(address))
+        logger.debug('Configure device %#x', address)
         bus.write_byte(address, config)
+        MCP342x._set_device_config(bus, address, config)
+
+    @staticmethod
+    def _has_rdwr(bus):
+        # Can plain I2C transactions be used on this bus?
+        return i2c_msg is not None and hasattr(bus, 'i2c_rdwr')
+
+    @staticmethod
+    def _write_many(bus, writes):
+        """Write one byte to each of several devices on the same bus.
+
+        writes is a sequence of (address, byte) tuples. Configuration
+        bytes which the device is known to hold already are not
+        written again; general calls (address 0) are always sent. When
+        the bus supports I2C_RDWR (smbus2) the writes are queued in as
+        few ioctl calls as possible, otherwise write_byte() is used."""
+        writes = [(addr, b) for addr, b in writes
+                  if (addr == 0 or b & MCP342x._not_ready_mask
+                      or MCP342x._get_device_config(bus, addr) != b)]
+        if MCP342x._has_rdwr(bus):
+            msgs = [i2c_msg.write(addr, [b]) for addr, b in writes]
+            n = MCP342x._max_rdwr_msgs
+            for i in range(0, len(msgs), n):
+                bus.i2c_rdwr(*msgs[i:i + n])
+        else:
+            for addr, b in writes:
+                bus.write_byte(addr, b)
+        for addr, b in writes:
+            if addr != 0:
+                MCP342x._set_device_config(bus, addr, b)
+
+    @staticmethod
+    def _run_in_threads(func, args_list):
+        """Call func once for each tuple of arguments in args_list.
+
+        Calls after the first are made in their own threads. Any
+        exception raised by a call is re-raised once all calls have
+        finished. The threads are joined even if the first call is
+        interrupted, and are daemon threads so that they cannot keep
+        the interpreter alive."""
+        if not args_list:
+            return
+        errors = []
+
+        def run(args):
+            try:
+                func(*args)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(args, ))
+                   for args in args_list[1:]]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            run(args_list[0])
+        finally:
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
 
     @staticmethod
     def convert_and_read_many(adcs, 
                               samples=None, 
                               aggregate=None, 
-                              raw=False):
+                              raw=False,
+                              general_call=True):
+        """Convert and read from many ADCs.
+
+        Channels on the same device are sampled in turn; different
+        devices, and devices on different buses, are sampled at the
+        same time. With general_call=True conversions are started by a
+        general call so that they are simultaneous, otherwise each
+        device is started with its own write.
+
+        Returns a list with one entry per ADC. If samples is given
+        each entry is a list of that many readings, which
+        numpy.asarray() turns into a 2-D array. If aggregate is given
+        it is called with each entry in turn and the results
+        returned instead."""
         # Group the sampling into batches with different device
         # addresses (cannot simultaneously sample from different
         # channels of the same device). Devices may not all be on the
         # same bus.
         batches = {}           # dict of lists
-        addresses = {}         # dict of lists
         position = {}          # dict of lists
-        unique_addresses = {}  # dict of dicts
-        num_batches = 0
-        pn = -1
-        for a in adcs:
-            pn += 1
-            bus = a.get_bus()
+        unique_addresses = {}  # dict of sets
+        addr_count = {}        # number of ADCs seen per (bus, address)
+        for pn, a in enumerate(adcs):
+            bus = a.bus
+            addr = a.address
             if bus not in batches:
                 batches[bus] = []
-                addresses[bus] = []
                 position[bus] = []
-                unique_addresses[bus] = {}
-            done = False
-            # Check if this sampling can be done with one of the
-            # existing batches of sampling
-            for n in range(len(addresses[bus])):
-                if a.get_address() not in addresses[bus][n]:
-                    # Use existing batch
-                    batches[bus][n].append(a)
-                    addresses[bus][n].append(a.get_address())
-                    position[bus][n].append(pn)
-                    unique_addresses[bus][a.get_address()] = None
-                    done = True
-                    break
-            if not done:
+                unique_addresses[bus] = set()
+            # The first ADC for a device goes in the first batch, the
+            # second in the second batch and so on.
+            bn = addr_count.get((bus, addr), 0)
+            addr_count[(bus, addr)] = bn + 1
+            if bn == len(batches[bus]):
                 # Must start a new batch
-                batches[bus].append([a])
-                addresses[bus].append([a.get_address()])
-                position[bus].append([pn])
-                unique_addresses[bus][a.get_address()] = None
-                # Remember highest numbered batch across all buses
-                num_batches = max(num_batches, len(batches[bus]))
-        
-        if samples is not None:
-            # Must avoid duplicating the same list when initializing!
-            results = [[0] * samples for _ in range(len(adcs))]
+                batches[bus].append([])
+                position[bus].append([])
+            batches[bus][bn].append(a)
+            position[bus][bn].append(pn)
+            unique_addresses[bus].add(addr)
+
+        # Without samples a single reading is taken from each ADC. It
+        # is stored like any other sample and unwrapped at the end.
+        num_samples = 1 if samples is None else samples
+        # Must avoid duplicating the same list when initializing!
+        results = [[0] * num_samples for _ in range(len(adcs))]
+
+        # The writes which start each batch do not change between
+        # samples so compute them once. Configure all devices from the
+        # batch, then a general call convert starts all conversions
+        # together. Configure unused devices for 12-bit sampling so
+        # that we aren't waiting for them to complete sampling later.
+        writes = {}  # dict of lists
+        setup = {}   # writes needed once, before sampling
+        chains = {}  # dict of dicts, the ADCs of each device in batch order
+        for bus in batches:
+            if not general_call:
+                chains[bus] = {}
+                for batch in batches[bus]:
+                    for a in batch:
+                        chains[bus].setdefault(a.address, []).append(a)
+                continue
+            writes[bus] = []
+            for batch in batches[bus]:
+                w = [(a.address, a.config) for a in batch]
+                unused = unique_addresses[bus] - set(a.address
+                                                     for a in batch)
+                w.extend((addr, 0) for addr in sorted(unused))
+                if len(batches[bus]) == 1:
+                    # The configuration is the same for every sample
+                    # so only needs writing once.
+                    setup[bus] = w
+                    w = []
+                w.append((0, 8))
+                writes[bus].append(w)
+
+        # With the general call the conversions on all buses are started
+        # together, so that the samples are time-aligned.
+        num_batches = max([len(b) for b in batches.values()] or [0])
+        if general_call and len(batches) > 1:
+            barrier = _Barrier(len(batches))
         else:
-            results = [0] * len(adcs)
-
-        for sn in ([0] if samples is None else range(samples)):
-            # Configure all devices from each batch, for each bus. Issues
-            # general_call_convert for all buses then read back the
-            # results from each batch.
-            for bn in range(num_batches):
-                # Configure
-                for bus in batches:
-                    if bn < len(batches[bus]):
-                        unconfigured_devices = {
-                            key: None for key in unique_addresses[bus]}
-                        for a in batches[bus][bn]:
-                            a.configure()
-                            del unconfigured_devices[a.get_address()]
-                        # Configure unused devices for 12-bit sampling so
-                        # that we aren't waiting for them to complete
-                        # sampling later
-                        for addr in unconfigured_devices:
-                            MCP342x.configure_device(bus, addr, 0)
-
-                # Convert
-                for bus in batches:
-                    if bn < len(batches[bus]):
-                        MCP342x.general_call_convert(bus)
-
-                # Read results
-                for bus in batches:
-                    if bn < len(batches[bus]):
-                        for n in range(len(batches[bus][bn])):
-                            a = batches[bus][bn][n]
-                            pn = position[bus][bn][n]
-                            if samples:
-                                results[pn][sn] = a.read(raw=raw)
-                            else:
-                                results[pn] = a.read(raw=raw)
-
+            barrier = None
+
+        # Set when sampling fails on any bus (including by
+        # KeyboardInterrupt) so that the other buses stop too.
+        stop = threading.Event()
+
+        def sample_bus(bus):
+            try:
+                if general_call:
+                    sample_batches(bus)
+                else:
+                    sample_pipelined(bus)
+            except _BarrierAborted:
+                # Another bus failed, its exception is raised instead
+                pass
+            except BaseException:
+                stop.set()
+                if barrier:
+                    barrier.abort()
+                raise
+
+        def sample_batches(bus):
+            if bus in setup:
+                logger.debug('Write devices %s', setup[bus])
+                MCP342x._write_many(bus, setup[bus])
+            for sn in range(num_samples):
+                for bn in range(num_batches if barrier
+                                else len(batches[bus])):
+                    if stop.is_set():
+                        return
+                    if barrier:
+                        barrier.wait()
+                        if bn >= len(batches[bus]):
+                            continue
+                    logger.debug('Write devices %s', writes[bus][bn])
+                    MCP342x._write_many(bus, writes[bus][bn])
+                    t = _monotonic()
+                    for a in batches[bus][bn]:
+                        a._conversion_start = t
+
+                    for n in range(len(batches[bus][bn])):
+                        a = batches[bus][bn][n]
+                        pn = position[bus][bn][n]
+                        results[pn][sn] = a.read(raw=raw)
+
+        def start(bus, adcs):
+            # Writing the configuration with the not ready bit set
+            # starts the conversion, so each device needs only one
+            # write and they can be sent together.
+            w = [(a.address, a.config | MCP342x._not_ready_mask)
+                 for a in adcs]
+            logger.debug('Write devices %s', w)
+            MCP342x._write_many(bus, w)
+            t = _monotonic()
+            for a in adcs:
+                a._conversion_start = t
+
+        def sample_pipelined(bus):
+            # Without the general call each device can be started on
+            # its own, so a device's next conversion is started as
+            # soon as its current result has been read. It then
+            # converts while the other devices on the bus are read
+            # instead of waiting for the whole batch to complete.
+            chain = chains[bus]
+            start(bus, [c[0] for c in chain.values()])
+            for sn in range(num_samples):
+                for bn in range(len(batches[bus])):
+                    if stop.is_set():
+                        return
+                    for n in range(len(batches[bus][bn])):
+                        a = batches[bus][bn][n]
+                        pn = position[bus][bn][n]
+                        results[pn][sn] = a.read(raw=raw)
+                        c = chain[a.address]
+                        if bn + 1 < len(c):
+                            start(bus, [c[bn + 1]])
+                        elif sn + 1 < num_samples:
+                            start(bus, [c[0]])
+
+        # The buses are independent so sample each of them in its own
+        # thread for the whole run.
+        MCP342x._run_in_threads(sample_bus, [(bus, ) for bus in batches])
+
+        if samples is None:
+            results = [r[0] for r in results]
         if aggregate:
-            for pn in range(len(adcs)):
-                results[pn] = aggregate(results[pn])
+            results = [aggregate(r) for r in results]
         return results
 
     def __init__(self, 
@@ -184,24 +478,50 @@ class MCP342x(object):
 
         if device not in ('MCP3422', 'MCP3423', 'MCP3424', 
                           'MCP3426', 'MCP3427', 'MCP3428'):
-            raise Exception('Unknown device: ' + str(device))
+            raise ValueError('Unknown device: ' + str(device))
         self.bus = bus
         self.address = address
-        self.config = 0
         self.device = device
-        self.scale_factor = scale_factor
+        # Set before the configuration, which derives the scale from it
+        self._scale_factor = scale_factor
         self.offset = offset
-
-        self.set_channel(channel)
-        self.set_gain(gain)
-        self.set_resolution(resolution)
-        self.set_continuous_mode(continuous_mode)
+        self._conversion_start = None
+        self._sleep_factor = MCP342x._default_sleep_factor
+
+        self._check_channel(channel)
+        self._check_gain(gain)
+        self._check_resolution(resolution)
+        self.config = (MCP342x._channel_to_config[channel]
+                       | MCP342x._gain_to_config[gain]
+                       | MCP342x._resolution_to_config[resolution]
+                       | (MCP342x._continuous_mode_mask if continuous_mode
+                          else 0))
 
     def __repr__(self):
         addr = hex(self.address)
         return (type(self).__name__ + ': device=' + self.device 
                 + ', address=' + addr)
 
+    # The values derived from config and scale_factor are updated
+    # whenever either attribute is assigned to.
+    @property
+    def config(self):
+        return self._config
+
+    @config.setter
+    def config(self, config):
+        self._config = config
+        self._update_derived()
+
+    @property
+    def scale_factor(self):
+        return self._scale_factor
+
+    @scale_factor.setter
+    def scale_factor(self, scale_factor):
+        self._scale_factor = scale_factor
+        self._scale = self._volts_per_count * scale_factor
+
     def get_bus(self):
         return self.bus
 
@@ -209,16 +529,16 @@ class MCP342x(object):
         return self.address
 
     def get_gain(self):
-        return MCP342x.config_to_gain(self.config)
+        return self._gain
 
     def get_resolution(self):
-        return MCP342x.config_to_resolution(self.config)
+        return self._resolution
 
     def get_continuous_mode(self):
         return bool(self.config & MCP342x._continuous_mode_mask)
 
     def get_channel(self):
-        return [g for g, c in iter(MCP342x._channel_to_config.items()) if c == self.config & MCP342x._channel_mask][0]
+        return self._channel
 
     def get_config(self):
         return self.config
@@ -236,40 +556,46 @@ class MCP342x(object):
     def set_address(self, address):
         self.address = address
 
-    def set_gain(self, gain):
+    def _check_gain(self, gain):
         if gain not in MCP342x._gain_to_config:
-            raise Exception('Illegal gain')
+            raise ValueError('Illegal gain: ' + str(gain))
 
-        self.config &= (~MCP342x._gain_mask & 0x7f)
-        self.config |= MCP342x._gain_to_config[gain]
-
-    def set_resolution(self, resolution):
+    def _check_resolution(self, resolution):
         if resolution not in MCP342x._resolution_to_config:
-            raise Exception('Illegal resolution')
+            raise ValueError('Illegal resolution: ' + str(resolution))
         elif resolution == 18 and \
                 self.device not in ('MCP3422', 'MCP3423', 'MCP3424'):
-            raise Exception('18 bit sampling not suuported by ' +
-                            self.device)
-            
-        self.config &= (~MCP342x._resolution_mask & 0x7f)
-        self.config |= MCP342x._resolution_to_config[resolution]
+            raise ValueError('18 bit sampling not supported by ' +
+                             self.device)
+
+    def _check_channel(self, channel):
+        if channel not in MCP342x._channel_to_config:
+            raise ValueError('Illegal channel: ' + str(channel))
+        elif channel in (2, 3) and \
+                self.device not in ('MCP3424', 'MCP3428'):
+            raise ValueError('Channel ' + str(channel) +
+                             ' not supported by ' + self.device)
+
+    def set_gain(self, gain):
+        self._check_gain(gain)
+        self.config = ((self.config & MCP342x._gain_clear_mask)
+                       | MCP342x._gain_to_config[gain])
+
+    def set_resolution(self, resolution):
+        self._check_resolution(resolution)
+        self.config = ((self.config & MCP342x._resolution_clear_mask)
+                       | MCP342x._resolution_to_config[resolution])
 
     def set_continuous_mode(self, continuous_mode):
         if continuous_mode:
             self.config |= MCP342x._continuous_mode_mask
         else:
-            self.config &= (~MCP342x._continuous_mode_mask & 0x7f)
+            self.config &= MCP342x._continuous_mode_clear_mask
 
     def set_channel(self, channel):
-        if channel not in MCP342x._channel_to_config:
-            raise Exception('Illegal channel')
-        elif channel in (2, 3) and \
-                self.device not in ('MCP3424', 'MCP3428'):
-            raise Exception('Channel ' + str(channel) + 
-                            ' not supported by ' + self.device)
-
-        self.config &= (~MCP342x._channel_mask & 0x7f)
-        self.config |= MCP342x._channel_to_config[channel]
+        self._check_channel(channel)
+        self.config = ((self.config & MCP342x._channel_clear_mask)
+                       | MCP342x._channel_to_config[channel])
 
     def set_scale_factor(self, scale_factor):
         self.scale_factor = scale_factor
@@ -281,83 +607,193 @@ class MCP342x(object):
         self.config = config & 0x7f
 
     def get_conversion_time(self):
-        return MCP342x._conversion_time[self.get_resolution()] 
+        return self._conversion_time
+
+    def _update_derived(self):
+        # Values derived from the configuration are needed for every
+        # sample, so compute them only when the configuration is set.
+        config = self._config
+        res = MCP342x.config_to_resolution(config)
+        self._resolution = res
+        self._gain = MCP342x.config_to_gain(config)
+        self._channel = MCP342x._config_to_channel[
+            config & MCP342x._channel_mask]
+        self._lsb = MCP342x._resolution_to_lsb[res]
+        self._conversion_time = MCP342x._conversion_time[res]
+        self._bytes_to_read = MCP342x._resolution_to_bytes[res]
+        self._count_mask = MCP342x._resolution_to_count_mask[res]
+        self._sign_bit = MCP342x._resolution_to_sign_bit[res]
+        self._volts_per_count = self._lsb / self._gain
+        self._scale = self._volts_per_count * self._scale_factor
 
     def configure(self):
         """Configure the device.
 
         Send the device configuration saved inside the MCP342x object to the target device."""
-        logger.debug('Configuring ' + hex(self.get_address())
-                     + ' ch: ' + str(self.get_channel())
-                     + ' res: ' + str(self.get_resolution())
-                     + ' gain: ' + str(self.get_gain()))
+        logger.debug('Configuring %#x ch: %d res: %d gain: %d',
+                     self.address, self._channel, self._resolution,
+                     self._gain)
         self.bus.write_byte(self.address, self.config)
+        MCP342x._set_device_config(self.bus, self.address, self.config)
 
     def convert(self):
-        """Initiate one-shot conversion.
+        """Initiate conversion.
+
+        In one-shot mode a single conversion is started using the
+        current settings. In continuous mode the device converts
+        without further commands, so nothing is written unless the
+        device is not known to have the current configuration, in
+        which case it is configured."""
+        if self.config & MCP342x._continuous_mode_mask:
+            if (MCP342x._get_device_config(self.bus, self.address)
+                    != self.config):
+                self.configure()
+                self._conversion_start = _monotonic()
+            return
 
-        The current settings are used, with the exception of continuous mode."""
         c = self.config
-        c &= (~MCP342x._continuous_mode_mask & 0x7f)  # Force one-shot
         c |= MCP342x._not_ready_mask                  # Convert
-        logger.debug('Convert ' + hex(self.address) + ' config: ' + bin(c))
+        logger.debug('Convert %#x config: %#04x', self.address, c)
         self.bus.write_byte(self.address, c)
+        MCP342x._set_device_config(self.bus, self.address, c)
+        self._conversion_start = _monotonic()
+
+    def _wait_for_conversion(self):
+        """Sleep until the conversion started by convert() should be complete.
+
+        The sleep is reduced by the time which has already elapsed
+        since the conversion was started. Returns immediately if no
+        conversion is known to be in progress."""
+        if self._conversion_start is None:
+            return
+        delay = (self._conversion_start
+                 + self._sleep_factor * self._conversion_time
+                 - _monotonic())
+        if delay > 0:
+            time.sleep(delay)
 
-    def raw_read(self):
-        res = self.get_resolution()
-        bytes_to_read = 4 if res == 18 else 3
-        while True:
-            # Stupid smbus forces us to write a byte of data, even
-            # with its 'I2C' write command. For MCP342x this forces us
-            # to overwrite the configuration setting.
-            #
-            # The correct action would be to check the configuration
-            # reported by raw_read() matches the stored configuration
-            # in the object. This can't be done since we have to
-            # destroy the actual value before reading.
-            d = self.bus.read_i2c_block_data(self.address, 
-                                             self.config, 
-                                             bytes_to_read)
-            config_used = d[-1]
-            if config_used & MCP342x._not_ready_mask == 0:
-                count = 0
-                for i in range(bytes_to_read - 1):
-                    count <<= 8
-                    count |= d[i]
-
-                sign_bit_mask = 1 << (res - 1)
-                count_mask = sign_bit_mask - 1
-                sign_bit = count & sign_bit_mask
-                count &= count_mask
-                if sign_bit:
-                    count = -(~count & count_mask) - 1
-                
-                return count, config_used
+    @staticmethod
+    def _decode(data, count_mask, sign_bit):
+        """Decode the bytes read from the device.
+
+        Returns the signed count and the configuration byte."""
+        if len(data) == 4:
+            count = (data[0] << 16) | (data[1] << 8) | data[2]
+        else:
+            count = (data[0] << 8) | data[1]
+
+        # Discard any sign extension bits above the resolution, then
+        # convert from two's complement without branching.
+        return ((count & count_mask) ^ sign_bit) - sign_bit, data[-1]
+
+    def raw_read(self, sleep=True):
+        bytes_to_read = self._bytes_to_read
+        slept = (sleep and self._conversion_start is not None
+                 and self._conversion_time > MCP342x._max_poll_only_time)
+        # The timeout depends only on elapsed time, measured from the
+        # start of the conversion when it is known, never on how many
+        # polls have been made.
+        start = self._conversion_start
+        # Whatever happens the conversion is no longer pending once
+        # this returns, so a later read does not time out early.
+        try:
+            if slept:
+                self._wait_for_conversion()
+            deadline = ((_monotonic() if start is None else start)
+                        + MCP342x._timeout_factor * self._conversion_time)
+            # Local names for everything used in the polling loop
+            bus = self.bus
+            address = self.address
+            config = self.config
+            not_ready_mask = MCP342x._not_ready_mask
+            rdwr = MCP342x._has_rdwr(bus)
+            if rdwr:
+                # If the device is not known to hold this configuration
+                # write it with the first poll, as one combined
+                # transaction.
+                write_config = (MCP342x._get_device_config(bus, address)
+                                != config)
+                # One read message is filled in place by every poll, and
+                # the result taken from it as a single bytes object.
+                msg = i2c_msg.read(address, bytes_to_read)
+            else:
+                # Each poll writes the configuration, see below
+                MCP342x._set_device_config(bus, address, config)
+            polls = 0
+            while True:
+                # Checked before polling so that there is always one last
+                # poll after the deadline, in case this thread was not
+                # scheduled for a while.
+                timed_out = _monotonic() > deadline
+                polls += 1
+                if rdwr:
+                    # A plain I2C read, which leaves the configuration
+                    # setting untouched.
+                    if write_config:
+                        bus.i2c_rdwr(i2c_msg.write(address, [config]), msg)
+                        MCP342x._set_device_config(bus, address, config)
+                        write_config = False
+                    else:
+                        bus.i2c_rdwr(msg)
+                    d = _msg_data(msg)
+                else:
+                    # Stupid smbus forces us to write a byte of data,
+                    # even with its 'I2C' write command. For MCP342x this
+                    # forces us to overwrite the configuration setting.
+                    #
+                    # The correct action would be to check the
+                    # configuration reported by raw_read() matches the
+                    # stored configuration in the object. This can't be
+                    # done since we have to destroy the actual value
+                    # before reading.
+                    d = bus.read_i2c_block_data(address, config, bytes_to_read)
+                if d[-1] & not_ready_mask == 0:
+                    count, config_used = MCP342x._decode(d, self._count_mask,
+                                                         self._sign_bit)
+                    if slept:
+                        # Adapt the sleep factor, moving towards the full
+                        # conversion time if the device was still busy
+                        # after sleeping.
+                        target = (1.0 if polls > 1
+                                  else MCP342x._default_sleep_factor)
+                        self._sleep_factor += (MCP342x._sleep_factor_weight
+                                               * (target - self._sleep_factor))
+                    return count, config_used
+
+                if timed_out:
+                    break
+                if sleep:
+                    # Leave the bus free for other devices
+                    time.sleep(MCP342x._poll_interval)
+
+            MCP342x._forget_device_config(bus, address)
+            raise TimeoutError('Timed out waiting for conversion from '
+                               + hex(address))
+        finally:
+            self._conversion_start = None
                     
-    def read(self, scale_factor=None, offset=None, raw=False):
-        if scale_factor is None:
-            scale_factor = self.scale_factor
+    def read(self, scale_factor=None, offset=None, raw=False, sleep=True):
         if offset is None:
             offset = self.offset
-        count, config_used = self.raw_read()
-        # Go through the motions of checking that the configuration
-        # matches. Until raw_read() is able to read without
-        # overwriting the configuration setting this is unlikely to be
-        # very useful.
+        count, config_used = self.raw_read(sleep=sleep)
+        # Check that the configuration matches. Unless raw_read() is
+        # able to read without overwriting the configuration setting
+        # (which requires smbus2) this is unlikely to be very useful.
         if config_used != self.config:
-            raise Exception('Config does not match ('
-                            + MCP342x.config_to_str(config_used) + ' != ' 
-                            + MCP342x.config_to_str(self.config))
+            MCP342x._forget_device_config(self.bus, self.address)
+            raise IOError('Config does not match ('
+                          + MCP342x.config_to_str(config_used) + ' != '
+                          + MCP342x.config_to_str(self.config) + ')')
         
         if raw:
             return count
-        lsb = MCP342x.config_to_lsb(config_used)
         # With the standard scale_factor=1 this returns the voltage
         # difference between IN+ and IN-. Other scale_factors can be
         # used to account for gain or attenuation, or to convert
         # voltage to some sensor input value.
-        voltage = (count * lsb * scale_factor / MCP342x.config_to_gain(config_used)) + offset
-        return voltage
+        if scale_factor is None:
+            return count * self._scale + offset
+        return count * self._volts_per_count * scale_factor + offset
 
     def convert_and_read(self, 
                          sleep=True, 
@@ -366,11 +802,17 @@ class MCP342x(object):
                          **kwargs):
         if samples is not None:
             r = [0] * samples
+        continuous = self.get_continuous_mode()
+        if continuous:
+            # The device converts autonomously, configure it once and
+            # then read each result as it becomes available.
+            self.configure()
         for sn in ([0] if samples is None else range(samples)):
-            self.convert()
-            if sleep:
-                time.sleep(0.95 * self.get_conversion_time())
-            val = self.read(**kwargs)
+            if continuous:
+                self._conversion_start = _monotonic()
+            else:
+                self.convert()
+            val = self.read(sleep=sleep, **kwargs)
             if samples is not None:
                 r[sn] = val
             else:
@@ -379,5 +821,32 @@ class MCP342x(object):
             r = aggregate(r)
         return r
 
+    def convert_and_read_continuous(self, samples, **kwargs):
+        """Read many samples using continuous mode.
+
+        The device is configured once and then each result is read as
+        it becomes available, without a write to start each
+        conversion. The continuous mode setting of the object is
+        restored afterwards and written back to the device, so that a
+        device in one-shot mode does not keep converting. Other
+        arguments are passed to convert_and_read()."""
+        continuous_mode = self.get_continuous_mode()
+        self.set_continuous_mode(True)
+        completed = False
+        try:
+            r = self.convert_and_read(samples=samples, **kwargs)
+            completed = True
+        finally:
+            self.set_continuous_mode(continuous_mode)
+            try:
+                self.configure()
+            except Exception:
+                if completed:
+                    raise
+                # Do not hide the error which is already propagating
+                logger.debug('Could not restore the mode of %#x',
+                             self.address)
+        return r
+
 
 logger = logging.getLogger(__name__)
@@ -0,0 +1,363 @@
+"""Tests for MCP342x using simulated devices on fake I2C buses."""
+
+import threading
+import time
+import unittest
+
+import MCP342x as mcp342x_module
+from MCP342x import MCP342x
+
+# Tests are run from the main thread
+_main_thread = threading.current_thread()
+
+try:
+    TimeoutError
+except NameError:
+    # Python 2
+    TimeoutError = IOError
+
+
+class FakeDevice(object):
+    """Simulated MCP342x device.
+
+    Conversions take half of the nominal conversion time. Each result
+    reads as ready once, as with the real device."""
+
+    def __init__(self):
+        self.reset()
+        self.never_ready = False
+
+    def reset(self):
+        # Power-on default is continuous mode, converting
+        self.config = 0x10
+        self.start()
+
+    def start(self):
+        res = MCP342x._config_to_resolution[self.config & 0x0c]
+        self.done_at = (time.time()
+                        + 0.5 * MCP342x._conversion_time[res])
+        self.unread = False
+
+    def value(self):
+        # Distinct signed value for each channel and resolution
+        channel = (self.config >> 5) & 3
+        res = MCP342x._config_to_resolution[self.config & 0x0c]
+        return (-1) ** channel * (channel + 1) * 100 + res - 12
+
+    def write(self, b):
+        self.config = b & 0x7f
+        if b & 0x80 or self.config & 0x10:
+            self.start()
+
+    def read(self, n):
+        ready = False
+        if not self.never_ready and self.done_at is not None:
+            if time.time() >= self.done_at:
+                self.done_at = None
+                self.unread = True
+        if self.unread:
+            ready = True
+            self.unread = False
+            if self.config & 0x10:
+                self.start()
+        v = self.value() & 0xffffff
+        data = [(v >> 16) & 0xff, (v >> 8) & 0xff, v & 0xff]
+        if n == 3:
+            data = data[1:]
+        else:
+            data = data[:n - 1]
+        return data + [self.config | (0 if ready else 0x80)]
+
+
+class FakeSMBus(object):
+    """Fake bus offering only the SMBus calls used by MCP342x."""
+
+    def __init__(self, addresses):
+        self.devices = dict((a, FakeDevice()) for a in addresses)
+        self.writes = []
+
+    def write_byte(self, address, b):
+        self.writes.append((address, b))
+        if address == 0:
+            for d in self.devices.values():
+                if b == 6:
+                    d.reset()
+                elif b == 8:
+                    d.start()
+        else:
+            self.devices[address].write(b)
+
+    def read_i2c_block_data(self, address, cmd, n):
+        self.devices[address].write(cmd)
+        return self.devices[address].read(n)
+
+
+class FakeMsg(object):
+    """Stand-in for smbus2.i2c_msg."""
+
+    def __init__(self, addr, flags, buf):
+        self.addr = addr
+        self.flags = flags
+        self.buf = buf
+
+    @staticmethod
+    def read(address, n):
+        return FakeMsg(address, 1, [0] * n)
+
+    @staticmethod
+    def write(address, buf):
+        return FakeMsg(address, 0, list(buf))
+
+    def __iter__(self):
+        return iter(self.buf)
+
+    def __bytes__(self):
+        return bytes(bytearray(self.buf))
+
+
+class FakeRdwrBus(FakeSMBus):
+    """Fake bus which also supports I2C_RDWR, like smbus2."""
+
+    def i2c_rdwr(self, *msgs):
+        for m in msgs:
+            if m.flags:
+                m.buf[:] = self.devices[m.addr].read(len(m.buf))
+            else:
+                for b in m.buf:
+                    self.write_byte(m.addr, b)
+
+
+class FailingBus(FakeRdwrBus):
+    """Bus whose reads raise error once reads have been made."""
+
+    def __init__(self, addresses, error, reads=2):
+        FakeRdwrBus.__init__(self, addresses)
+        self.error = error
+        self.reads = reads
+
+    def i2c_rdwr(self, *msgs):
+        if any(m.flags for m in msgs):
+            self.reads -= 1
+            if self.reads < 0:
+                raise self.error
+        FakeRdwrBus.i2c_rdwr(self, *msgs)
+
+
+class InterruptedBus(FakeRdwrBus):
+    """Bus on which Ctrl-C arrives during a read.
+
+    Signals are only delivered to the main thread, so the interrupt
+    is raised only when reading from it."""
+
+    def __init__(self, addresses, reads=2):
+        FakeRdwrBus.__init__(self, addresses)
+        self.reads = reads
+
+    def i2c_rdwr(self, *msgs):
+        if (any(m.flags for m in msgs)
+                and threading.current_thread() is _main_thread):
+            self.reads -= 1
+            if self.reads < 0:
+                raise KeyboardInterrupt()
+        FakeRdwrBus.i2c_rdwr(self, *msgs)
+
+
+class FakeBusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._i2c_msg = mcp342x_module.i2c_msg
+        mcp342x_module.i2c_msg = FakeMsg
+        self._threads = threading.active_count()
+
+    def tearDown(self):
+        mcp342x_module.i2c_msg = self._i2c_msg
+        # No worker threads may be left running
+        self.assertEqual(threading.active_count(), self._threads)
+
+    def make_adcs(self, bus, resolution=12):
+        adcs = [MCP342x(bus, 0x68, channel=c, resolution=resolution)
+                for c in range(4)]
+        adcs += [MCP342x(bus, 0x69, channel=c, resolution=resolution)
+                 for c in range(2)]
+        return adcs
+
+
+class TestConvertAndReadMany(FakeBusTestCase):
+
+    expected = [100, -200, 300, -400, 100, -200]
+
+    def test_results_in_adc_order(self):
+        for bus_class in (FakeSMBus, FakeRdwrBus):
+            for general_call in (True, False):
+                bus = bus_class([0x68, 0x69])
+                r = MCP342x.convert_and_read_many(
+                    self.make_adcs(bus), raw=True,
+                    general_call=general_call)
+                self.assertEqual(r, self.expected)
+
+    def test_samples_and_aggregate(self):
+        for general_call in (True, False):
+            bus = FakeRdwrBus([0x68, 0x69])
+            adcs = self.make_adcs(bus)
+            r = MCP342x.convert_and_read_many(adcs, samples=3, raw=True,
+                                              general_call=general_call)
+            self.assertEqual(r, [[v] * 3 for v in self.expected])
+            r = MCP342x.convert_and_read_many(adcs, samples=3, raw=True,
+                                              aggregate=sum,
+                                              general_call=general_call)
+            self.assertEqual(r, [3 * v for v in self.expected])
+
+    def test_many_buses(self):
+        bus1 = FakeRdwrBus([0x68, 0x69])
+        bus2 = FakeSMBus([0x68])
+        adcs = (self.make_adcs(bus1)
+                + [MCP342x(bus2, 0x68, channel=c) for c in (1, 0)])
+        for general_call in (True, False):
+            r = MCP342x.convert_and_read_many(adcs, samples=2, raw=True,
+                                              general_call=general_call)
+            self.assertEqual(r, [[v] * 2
+                                 for v in self.expected + [-200, 100]])
+
+    def test_error_on_one_bus(self):
+        for first in (True, False):
+            for general_call in (True, False):
+                bus1 = FailingBus([0x68], ValueError('bus failed'))
+                bus2 = FakeRdwrBus([0x68])
+                adcs = [MCP342x(bus1, 0x68), MCP342x(bus2, 0x68)]
+                if not first:
+                    adcs.reverse()
+                with self.assertRaises(ValueError):
+                    MCP342x.convert_and_read_many(
+                        adcs, samples=20, general_call=general_call)
+
+    def test_keyboard_interrupt(self):
+        for general_call in (True, False):
+            bus1 = InterruptedBus([0x68])
+            bus2 = InterruptedBus([0x68])
+            adcs = [MCP342x(bus1, 0x68), MCP342x(bus2, 0x68)]
+            t = time.time()
+            with self.assertRaises(KeyboardInterrupt):
+                MCP342x.convert_and_read_many(adcs, samples=200,
+                                              general_call=general_call)
+            # The other bus stops early rather than completing the run
+            self.assertLess(time.time() - t, 0.2)
+
+
+class TestRead(FakeBusTestCase):
+
+    def test_resolutions(self):
+        for bus_class in (FakeSMBus, FakeRdwrBus):
+            bus = bus_class([0x68])
+            for res in (12, 14, 16, 18):
+                adc = MCP342x(bus, 0x68, channel=1, resolution=res)
+                self.assertEqual(adc.convert_and_read(raw=True),
+                                 -200 + res - 12)
+
+    def test_scale(self):
+        bus = FakeRdwrBus([0x68])
+        adc = MCP342x(bus, 0x68, channel=2, resolution=16, gain=4)
+        self.assertAlmostEqual(adc.convert_and_read(),
+                               304 * 62.5e-6 / 4)
+        adc.scale_factor = 2.0
+        self.assertAlmostEqual(adc.convert_and_read(),
+                               2 * 304 * 62.5e-6 / 4)
+
+    def test_assign_config(self):
+        bus = FakeRdwrBus([0x68])
+        adc = MCP342x(bus, 0x68, channel=0, resolution=12)
+        adc.config |= MCP342x._resolution_to_config[18]
+        self.assertEqual(adc.get_resolution(), 18)
+        self.assertEqual(adc.convert_and_read(raw=True), 106)
+
+    def test_continuous_channels(self):
+        bus = FakeRdwrBus([0x68])
+        a = MCP342x(bus, 0x68, channel=0, continuous_mode=True)
+        c = MCP342x(bus, 0x68, channel=2, continuous_mode=True)
+        for i in range(3):
+            self.assertEqual(a.read(raw=True), 100)
+            self.assertEqual(c.read(raw=True), 300)
+
+    def test_convert_and_read_continuous(self):
+        bus = FakeRdwrBus([0x68])
+        adc = MCP342x(bus, 0x68, channel=3)
+        self.assertEqual(adc.convert_and_read_continuous(3, raw=True),
+                         [-400] * 3)
+        self.assertFalse(adc.get_continuous_mode())
+        self.assertEqual(bus.devices[0x68].config, adc.config)
+
+
+class TestTimeout(FakeBusTestCase):
+
+    def test_timeout(self):
+        bus = FakeRdwrBus([0x68])
+        adc = MCP342x(bus, 0x68, resolution=12)
+        bus.devices[0x68].never_ready = True
+        t = time.time()
+        adc.convert()
+        with self.assertRaises(TimeoutError):
+            adc.read()
+        limit = MCP342x._timeout_factor * adc.get_conversion_time()
+        self.assertLess(time.time() - t, limit + 0.05)
+        self.assertIsNone(adc._conversion_start)
+
+        # The device recovers
+        bus.devices[0x68].never_ready = False
+        self.assertEqual(adc.convert_and_read(raw=True), 100)
+
+    def test_fast_bus(self):
+        # Polling without sleeping must not time out however fast the
+        # bus is.
+        bus = FakeRdwrBus([0x68])
+        adc = MCP342x(bus, 0x68, resolution=16)
+        self.assertEqual(adc.convert_and_read(raw=True, sleep=False), 104)
+
+    def test_bus_error_clears_conversion(self):
+        bus = FailingBus([0x68], ValueError('bus failed'), reads=0)
+        adc = MCP342x(bus, 0x68)
+        adc.convert()
+        with self.assertRaises(ValueError):
+            adc.read()
+        self.assertIsNone(adc._conversion_start)
+
+
+class TestDeviceConfigRecord(FakeBusTestCase):
+
+    def test_redundant_writes_skipped(self):
+        bus = FakeRdwrBus([0x68])
+        MCP342x._write_many(bus, [(0x68, 0x04)])
+        MCP342x._write_many(bus, [(0x68, 0x04), (0x68, 0x84), (0, 8)])
+        self.assertEqual(bus.writes,
+                         [(0x68, 0x04), (0x68, 0x84), (0, 8)])
+
+    def test_configure_always_writes(self):
+        bus = FakeRdwrBus([0x68])
+        adc = MCP342x(bus, 0x68)
+        adc.configure()
+        adc.configure()
+        self.assertEqual(bus.writes, [(0x68, adc.config)] * 2)
+
+    def test_general_call_reset(self):
+        bus = FakeRdwrBus([0x68])
+        MCP342x(bus, 0x68).configure()
+        MCP342x.general_call_reset(bus)
+        self.assertIsNone(MCP342x._get_device_config(bus, 0x68))
+
+    def test_recovers_from_drift(self):
+        bus = FakeRdwrBus([0x68])
+        adc = MCP342x(bus, 0x68, channel=1)
+        self.assertEqual(MCP342x.convert_and_read_many([adc], raw=True),
+                         [-200])
+        # For example after a power cycle
+        bus.devices[0x68].config = 0x10
+        results = []
+        for i in range(3):
+            try:
+                results.append(
+                    MCP342x.convert_and_read_many([adc], raw=True))
+            except IOError:
+                results.append(None)
+        self.assertEqual(results[1:], [[-200], [-200]])
+
+
+if __name__ == '__main__':
+    unittest.main()